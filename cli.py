@@ -8,6 +8,7 @@ or restore the system default wallpaper.
 
 import os
 import sys
+import json
 import subprocess
 import getpass
 from pathlib import Path
@@ -16,24 +17,37 @@ HOME = Path.home()
 AGENT_NAME = "com.himawari-live-wallpaper"
 PLIST_PATH = HOME / f"Library/LaunchAgents/{AGENT_NAME}.plist"
 SCRIPT_PATH = Path(__file__).parent / "himawari_wallpaper.py"
+SPECIALIZED_PATH = Path(__file__).parent / "_specialized.py"
 VENV_PATH = Path(__file__).parent / ".venv"
 VENV_PYTHON = VENV_PATH / "bin/python3"
+CONFIG_PATH = Path(__file__).parent / "config.json"
 
 def create_venv():
-    """Create virtual environment and install dependencies (only once)."""
+    """Create virtual environment (only once) and install/update dependencies."""
     if not VENV_PATH.exists():
         print("🌱 Creating virtual environment...")
         subprocess.run([sys.executable, "-m", "venv", str(VENV_PATH)], check=True)
-        print("📦 Installing dependencies...")
         subprocess.run([str(VENV_PYTHON), "-m", "pip", "install", "--upgrade", "pip"], check=True)
-        subprocess.run([str(VENV_PYTHON), "-m", "pip", "install", "-r", str(Path(__file__).parent / "requirements.txt")], check=True)
     else:
         print("✅ Virtual environment already exists. Skipping creation.")
+    # Always sync dependencies so upgrades pick up changes to requirements.txt
+    print("📦 Installing dependencies...")
+    subprocess.run([str(VENV_PYTHON), "-m", "pip", "install", "-r", str(Path(__file__).parent / "requirements.txt")], check=True)
+
+
+def generate_specialized():
+    """Generate _specialized.py with the current config baked in as constants."""
+    subprocess.run(
+        [str(VENV_PYTHON), "-c", "import himawari_wallpaper; himawari_wallpaper.generate_specialized()"],
+        cwd=str(Path(__file__).parent),
+        check=True,
+    )
 
 
 def install_agent():
-    """Install LaunchAgent to run himawari_wallpaper.py every 10 minutes."""
+    """Install LaunchAgent to run the specialized launcher every 10 minutes."""
     create_venv()
+    generate_specialized()
     username = getpass.getuser()
     plist_content = f"""<?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" 
@@ -46,7 +60,7 @@ def install_agent():
     <array>
         <string>{VENV_PYTHON}</string>
         <string>-u</string>
-        <string>{SCRIPT_PATH}</string>
+        <string>{SPECIALIZED_PATH}</string>
     </array>
     <key>StartInterval</key>
     <integer>600</integer>
@@ -73,8 +87,9 @@ def uninstall_agent():
 
 
 def run_once():
-    """Run himawari_wallpaper.py once manually."""
-    subprocess.run([str(VENV_PYTHON), str(SCRIPT_PATH)], check=True)
+    """Run the wallpaper update once manually, through the same launcher as the LaunchAgent."""
+    script = SPECIALIZED_PATH if SPECIALIZED_PATH.exists() else SCRIPT_PATH
+    subprocess.run([str(VENV_PYTHON), str(script)], check=True)
 
 
 def restore_wallpaper():
@@ -90,6 +105,9 @@ def restore_wallpaper():
     end tell
     '''
     subprocess.run(["osascript", "-e", script])
+    # Forget the last wallpaper set by himawari_wallpaper.py so the next run re-applies it
+    save_dir = Path(__file__).parent / json.loads(CONFIG_PATH.read_text())["save_dir"]
+    (save_dir / ".last_wallpaper").unlink(missing_ok=True)
     print("🔄 Wallpaper restored to default")
 
 
@@ -6,13 +6,16 @@ This script downloads Himawari satellite tiles, stitches them into a full image,
 resizes it to fit the screen, and sets it as the desktop wallpaper.
 """
 
+import glob
 import os
+import random
 import subprocess
-import requests
+import tempfile
+import threading
+import time
 import json
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from PIL import Image
 
 # Load configuration
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config.json")
@@ -32,13 +35,53 @@ COVER_RATIO = cfg["cover_ratio"]
 SAVE_DIR = Path(__file__).parent / cfg["save_dir"]
 PIC_SIZE = cfg["pic_size"]
 MAX_PIC = cfg["max_pic_count"]
+IMAGE_FORMAT = cfg.get("image_format", "png").lower()
+if IMAGE_FORMAT == "jpeg":
+    IMAGE_FORMAT = "jpg"
+if IMAGE_FORMAT not in ("png", "jpg"):
+    raise ValueError(f"Unsupported image_format {IMAGE_FORMAT!r} in config.json (use 'png' or 'jpg')")
+KEEP_INTERVAL_SECONDS = cfg.get("tile_keep_seconds", 3600)
+TILE_DIR = SAVE_DIR / "tiles"
+DL_WORKERS = int(os.environ.get("HIMAWARI_DL_WORKERS", 8))
+SCREEN_SIZE_CACHE = SAVE_DIR / ".screen_size.json"
+LAST_WALLPAPER = SAVE_DIR / ".last_wallpaper"
+SPECIALIZED_PATH = Path(__file__).parent / "_specialized.py"
+DESKTOP_PICTURE_DB = Path.home() / "Library/Application Support/Dock/desktoppicture.db"
+WINDOWSERVER_PLISTS = [
+    "/Library/Preferences/ByHost/com.apple.windowserver*.plist",
+    "/Library/Preferences/com.apple.windowserver*.plist",
+    str(Path.home() / "Library/Preferences/ByHost/com.apple.windowserver*.plist"),
+]
+
+# Wallpaper path is passed as an argument so the script text never changes
+SET_WALLPAPER_SCRIPT = '''
+on run argv
+    tell application "System Events"
+        tell every desktop
+            set picture to (item 1 of argv)
+        end tell
+    end tell
+end run
+'''
 
 os.makedirs(SAVE_DIR, exist_ok=True)
+os.makedirs(TILE_DIR, exist_ok=True)
+
+# Shared HTTP/2 client so all tile downloads are multiplexed over one connection.
+# Transient errors (connection resets, timeouts, 429/5xx) are retried with
+# exponential backoff before falling back to the next base URL.
+# httpx, numpy, cv2 and imagecodecs are imported inside the functions that use
+# them so runs that find the wallpaper already current start quickly.
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.2
+RETRY_STATUS = {429, 500, 502, 503, 504}
+CLIENT = None
+_CLIENT_LOCK = threading.Lock()
 
 
 def get_aligned_time():
     """Return the target time aligned to UPDATE_INTERVAL_MINUTES."""
-    now = datetime.utcnow()
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
     target = now - timedelta(minutes=DELAY_MINUTES)
     minute = (target.minute // UPDATE_INTERVAL_MINUTES) * UPDATE_INTERVAL_MINUTES
     return target.replace(minute=minute, second=0, microsecond=0)
@@ -49,134 +92,405 @@ def convert_time(time_str: str):
     return time_str.replace("/", "__")
 
 
-def list_png(dir_path_str: str):
-    """List all PNG files in a directory."""
-    dir_path = Path(dir_path_str)
-    return list(dir_path.glob("*.png"))
+def wallpaper_filename(time_str: str):
+    """Return the wallpaper filename for an aligned time string."""
+    return f"{ND}d_{TILE_SIZE}_{convert_time(time_str)}.{IMAGE_FORMAT}"
+
+
+def list_images(dir_path_str: str, suffixes=(".png", ".jpg")):
+    """List all image files in a directory as os.DirEntry objects."""
+    with os.scandir(dir_path_str) as it:
+        return [entry for entry in it if entry.name.endswith(suffixes) and entry.is_file()]
+
+
+def get_timestamp(entry):
+    """Return the modification time of a directory entry for sorting."""
+    return entry.stat().st_mtime
 
 
-def get_timestamp(file_path):
-    """Extract timestamp from filename for sorting."""
-    name = file_path.stem
-    parts = name.split("_")
-    return parts[2] if len(parts) >= 3 else "0"
+def clean_tile_cache(max_age=KEEP_INTERVAL_SECONDS):
+    """Remove cached tiles (and temp files left by interrupted writes) older than max_age seconds."""
+    now = time.time()
+    for tile in list_images(TILE_DIR, suffixes=(".png", ".tmp")):
+        if now - get_timestamp(tile) >= max_age:
+            os.unlink(tile.path)
 
 
-def clean_old_images(dir_path, max_images):
-    """Remove old images exceeding max_images count."""
-    images = list_png(dir_path)
+def clean_old_images(dir_path, max_images, keep=None):
+    """
+    Remove old images exceeding max_images count and expired cached tiles.
+    The image at path 'keep' (e.g. the one just written) is never removed.
+    """
+    clean_tile_cache()
+    keep_name = os.path.basename(keep) if keep else None
+    images = [img for img in list_images(dir_path) if img.name != keep_name]
     if len(images) <= max_images:
         return
     images.sort(key=get_timestamp)
     for img in images[:len(images)-max_images]:
-        print(f"Deleting old image {img}")
-        img.unlink()
+        print(f"Deleting old image {img.path}")
+        os.unlink(img.path)
+
+
+def _display_config_mtime():
+    """Return the latest mtime of the WindowServer display preferences."""
+    mtimes = [os.path.getmtime(p) for pattern in WINDOWSERVER_PLISTS for p in glob.glob(pattern)]
+    return max(mtimes, default=0)
 
 
 def get_screen_size():
-    """Return primary screen width and height."""
+    """
+    Return primary screen width and height.
+    The result is cached in SCREEN_SIZE_CACHE and only re-queried through
+    osascript when the display preferences change.
+    """
+    key = _display_config_mtime()
+    try:
+        cached = json.loads(SCREEN_SIZE_CACHE.read_text())
+        if cached["key"] == key:
+            return tuple(cached["size"])
+    except (OSError, ValueError, KeyError):
+        pass
+
     script = 'tell application "Finder" to get bounds of window of desktop'
     out = subprocess.check_output(["osascript", "-e", script]).decode()
     nums = [int(x.strip()) for x in out.replace("{","").replace("}","").split(",")]
     width = nums[2] - nums[0]
     height = nums[3] - nums[1]
+    SCREEN_SIZE_CACHE.write_text(json.dumps({"key": key, "size": [width, height]}))
     return width, height
 
 
+def get_client():
+    """Return the shared httpx client, creating it on first use."""
+    global CLIENT
+    with _CLIENT_LOCK:
+        if CLIENT is None:
+            import httpx
+            CLIENT = httpx.Client(
+                http2=True,
+                limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+                timeout=10.0,
+            )
+    return CLIENT
+
+
+def _get(url):
+    """GET url with the shared client, retrying transient failures with jittered backoff."""
+    import httpx
+
+    client = get_client()
+    for attempt in range(RETRY_TOTAL + 1):
+        try:
+            resp = client.get(url)
+            if resp.status_code not in RETRY_STATUS or attempt == RETRY_TOTAL:
+                resp.raise_for_status()
+                return resp
+        except httpx.TransportError:
+            if attempt == RETRY_TOTAL:
+                raise
+        time.sleep(RETRY_BACKOFF * 2 ** attempt + random.uniform(0, 0.1))
+
+
+def _decode_tile(data):
+    """
+    Decode PNG bytes into an RGB uint8 array with libpng via imagecodecs.
+    Gray, gray+alpha and RGBA tiles are converted to RGB and 16-bit tiles are
+    scaled down to 8 bits; any other sample type is rejected.
+    """
+    import imagecodecs
+    import numpy as np
+
+    arr = imagecodecs.png_decode(data)
+    if arr.dtype == np.uint16:
+        arr = (arr >> 8).astype(np.uint8)
+    elif arr.dtype != np.uint8:
+        raise ValueError(f"Unsupported tile sample type {arr.dtype}")
+    if arr.ndim == 2:
+        arr = arr[:, :, np.newaxis]
+    if arr.shape[2] < 3:
+        # Gray or gray+alpha: repeat the gray channel
+        return np.repeat(arr[:, :, :1], 3, axis=2)
+    return arr[:, :, :3]
+
+
+def _write_tile_cache(cache_path, data):
+    """
+    Atomically write tile bytes to cache_path via a temp file in TILE_DIR.
+    Failures are logged and ignored, the tile just isn't cached.
+    """
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(dir=TILE_DIR, suffix=".tmp", delete=False) as f:
+            tmp_path = f.name
+            f.write(data)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"⚠️ Failed to cache tile {cache_path}: {e}")
+        if tmp_path:
+            Path(tmp_path).unlink(missing_ok=True)
+
+
+def _fetch_tile(row, col, time_str):
+    """
+    Download and decode a single tile, returning (row, col, RGB array).
+    Reuse the cached tile if it is younger than KEEP_INTERVAL_SECONDS,
+    otherwise try multiple base URLs in order if a download fails.
+    Downloaded tiles are decoded in memory; they are written to the cache
+    only when KEEP_INTERVAL_SECONDS > 0 and decoding succeeded.
+    """
+    cache_path = TILE_DIR / f"tile_{ND}d_{TILE_SIZE}_{convert_time(time_str)}_{row}_{col}.png"
+    if cache_path.exists() and (time.time() - cache_path.stat().st_mtime) < KEEP_INTERVAL_SECONDS:
+        try:
+            arr = _decode_tile(cache_path.read_bytes())
+            print(f"Using cached tile {cache_path}")
+            return row, col, arr
+        except Exception as e:
+            print(f"⚠️ Discarding unreadable cached tile {cache_path}: {e}")
+            cache_path.unlink(missing_ok=True)
+
+    last_exception = None
+    for base_url in BASE_URL:
+        url = f"{base_url}/{ND}d/{TILE_SIZE}/{time_str}_{col}_{row}.png"
+        try:
+            print(f"Downloading {url}")
+            resp = _get(url)
+            arr = _decode_tile(resp.content)
+        except Exception as e:
+            print(f"⚠️ Failed to download from {url}: {e}")
+            last_exception = e
+            continue
+        if KEEP_INTERVAL_SECONDS > 0:
+            _write_tile_cache(cache_path, resp.content)
+        return row, col, arr
+    raise RuntimeError(f"Failed to download tile ({col},{row}) from all URLs") from last_exception
+
+
 def download_tiles(time_str):
     """
-    Download ND x ND tiles and return as PIL Image matrix.
-    Try multiple base URLs in order if a download fails.
+    Download ND x ND tiles concurrently and return as a matrix of RGB arrays.
+    Each worker both downloads and decodes its tile, so PNG decoding overlaps
+    with the network wait of the other tiles.
+    The number of worker threads is set by HIMAWARI_DL_WORKERS (default 8).
     """
-    tiles = []
-    for row in range(ND):
-        row_tiles = []
-        for col in range(ND):
-            success = False
-            last_exception = None
-            for base_url in BASE_URL:
-                url = f"{base_url}/{ND}d/{TILE_SIZE}/{time_str}_{col}_{row}.png"
-                try:
-                    print(f"Downloading {url}")
-                    resp = requests.get(url, timeout=10)
-                    resp.raise_for_status()
-                    img_path = os.path.join(SAVE_DIR, f"tile_{row}_{col}.png")
-                    with open(img_path, "wb") as f:
-                        f.write(resp.content)
-                    row_tiles.append(Image.open(img_path))
-                    success = True
-                    break  # stop trying other URLs
-                except Exception as e:
-                    print(f"⚠️ Failed to download from {url}: {e}")
-                    last_exception = e
-            if not success:
-                raise RuntimeError(f"Failed to download tile ({col},{row}) from all URLs") from last_exception
-        tiles.append(row_tiles)
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    jobs = [(row, col) for row in range(ND) for col in range(ND)]
+    tiles = [[None] * ND for _ in range(ND)]
+    with ThreadPoolExecutor(max_workers=DL_WORKERS) as executor:
+        futures = [executor.submit(_fetch_tile, row, col, time_str) for row, col in jobs]
+        try:
+            for future in as_completed(futures):
+                row, col, arr = future.result()
+                tiles[row][col] = arr
+        except BaseException:
+            # One missing tile fails the run; don't keep downloading the rest
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
     return tiles
 
 
-
 def stitch_tiles(tiles):
-    """Stitch ND x ND tiles into one large image."""
-    tile_w, tile_h = tiles[0][0].size
-    big_w, big_h = tile_w * ND, tile_h * ND
-    big_img = Image.new("RGB", (big_w, big_h))
+    """Stitch ND x ND decoded tiles into one large RGB array."""
+    import numpy as np
+
+    tile_h, tile_w = tiles[0][0].shape[:2]
+    big_img = np.empty((tile_h * ND, tile_w * ND, 3), dtype=np.uint8)
     for row in range(ND):
         for col in range(ND):
-            big_img.paste(tiles[row][col], (col * tile_w, row * tile_h))
+            big_img[row * tile_h:(row + 1) * tile_h, col * tile_w:(col + 1) * tile_w] = tiles[row][col]
     return big_img
 
 
-def resize_and_center(big_img, screen_size, cover_ratio):
-    """Resize big image and paste onto black background to fit screen."""
+def compute_layout(big_size, screen_size, cover_ratio):
+    """
+    Return (target_size, offset_x, offset_y) for placing a big_size image on screen.
+    The target snaps to big_size when within 2px so the resize can be skipped.
+    """
     W, H = screen_size
     short_edge = min(W, H)
     target_size = int(short_edge * cover_ratio)
-
-    bg = Image.new("RGB", (W, H), (0, 0, 0))
-    big_resized = big_img.resize((target_size, target_size), Image.LANCZOS)
+    if abs(big_size - target_size) <= 2:
+        target_size = min(big_size, short_edge)
     offset_x = (W - target_size) // 2
     offset_y = (H - target_size) // 2
-    bg.paste(big_resized, (offset_x, offset_y))
+    return target_size, offset_x, offset_y
+
+
+def resize_and_center(big_img, screen_size, cover_ratio, layout=None):
+    """
+    Resize big image and paste onto black background to fit screen.
+    'layout' may pass a precomputed compute_layout() result.
+    """
+    import cv2
+    import numpy as np
+
+    W, H = screen_size
+    big_img = np.asarray(big_img)
+    big_size = big_img.shape[0]
+    target_size, offset_x, offset_y = layout or compute_layout(big_size, screen_size, cover_ratio)
+
+    bg = np.zeros((H, W, 3), dtype=np.uint8)
+    if big_size == target_size:
+        big_resized = big_img
+    elif big_size > target_size:
+        # INTER_AREA is the recommended (and SIMD-vectorized) filter for shrinking
+        big_resized = cv2.resize(big_img, (target_size, target_size), interpolation=cv2.INTER_AREA)
+    else:
+        print(f"⚠️ Upscaling {big_size}px image to {target_size}px; increase nd or tile_size for more detail")
+        big_resized = cv2.resize(big_img, (target_size, target_size), interpolation=cv2.INTER_CUBIC)
+    # Clip to the canvas, as PIL's paste did, when the target exceeds the screen
+    x0, y0 = max(offset_x, 0), max(offset_y, 0)
+    x1, y1 = min(offset_x + target_size, W), min(offset_y + target_size, H)
+    bg[y0:y1, x0:x1] = big_resized[y0 - offset_y:y1 - offset_y, x0 - offset_x:x1 - offset_x]
     return bg
 
 
 def save_wallpaper(img, filename=None):
-    """Save image to SAVE_DIR with optional filename."""
+    """
+    Save RGB image array to SAVE_DIR with optional filename.
+    The format follows IMAGE_FORMAT ('png' or 'jpg') unless filename says otherwise.
+    """
+    import cv2
+
     if not filename:
         time_str = get_aligned_time().strftime("%Y/%m/%d/%H%M%S")
-        filename = f"{ND}d_{TILE_SIZE}_{convert_time(time_str)}.png"
+        filename = wallpaper_filename(time_str)
     out_path = os.path.join(SAVE_DIR, filename)
-    img.save(out_path)
+    if out_path.endswith(".jpg"):
+        params = [cv2.IMWRITE_JPEG_QUALITY, 92, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+    else:
+        # Low zlib level: satellite imagery barely compresses, so level 6+ only costs CPU
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 3]
+    # Write to a temp file with the same extension (cv2 picks the codec from it)
+    # and move it into place, so an interrupted write never leaves a partial
+    # file under the name main() treats as a finished wallpaper.
+    fd, tmp_path = tempfile.mkstemp(dir=SAVE_DIR, prefix=".", suffix=os.path.splitext(out_path)[1])
+    os.close(fd)
+    try:
+        if not cv2.imwrite(tmp_path, cv2.cvtColor(img, cv2.COLOR_RGB2BGR), params):
+            raise RuntimeError(f"Failed to write wallpaper {out_path}")
+        os.replace(tmp_path, out_path)
+    finally:
+        Path(tmp_path).unlink(missing_ok=True)
     return out_path
 
 
-def set_wallpaper(path):
-    """Set the image at 'path' as desktop wallpaper."""
-    script = f'''
-    tell application "System Events"
-        tell every desktop
-            set picture to "{path}"
-        end tell
-    end tell
-    '''
-    subprocess.call(["osascript", "-e", script])
-    print(f"Wallpaper updated: {path}")
+def wallpaper_is_still_applied():
+    """
+    Return True if the desktop picture has not been changed since the last
+    set_wallpaper call, judged by the mtime of the Dock's desktoppicture.db.
+    Without the database there is no way to tell, so return False.
+    """
+    try:
+        return DESKTOP_PICTURE_DB.stat().st_mtime <= LAST_WALLPAPER.stat().st_mtime
+    except FileNotFoundError:
+        return False
+
 
+def set_wallpaper(path, wait=True):
+    """
+    Set the image at 'path' as desktop wallpaper, unless it is already set.
+    With wait=False the osascript process is returned still running; pass it
+    to finish_set_wallpaper() once other work is done.
+    """
+    try:
+        if LAST_WALLPAPER.read_text() == path and wallpaper_is_still_applied():
+            print(f"Wallpaper already set: {path}")
+            return None
+    except FileNotFoundError:
+        pass
+
+    proc = subprocess.Popen(["osascript", "-", path], stdin=subprocess.PIPE, text=True)
+    proc.stdin.write(SET_WALLPAPER_SCRIPT)
+    proc.stdin.close()
+    if wait:
+        finish_set_wallpaper(proc, path)
+    return proc
+
+
+def finish_set_wallpaper(proc, path):
+    """Wait for an osascript process started by set_wallpaper() and record the result."""
+    if proc is None:
+        return
+    returncode = proc.wait()
+    if returncode != 0:
+        print(f"⚠️ Failed to set wallpaper {path}: osascript exited with status {returncode}")
+        return
+    LAST_WALLPAPER.write_text(path)
+    print(f"Wallpaper updated: {path}")
 
-def main():
-    """Main function to download, stitch, resize, save, and set wallpaper."""
-    clean_old_images(SAVE_DIR, MAX_PIC)
 
+def main(layout=None):
+    """
+    Main function to download, stitch, resize, save, and set wallpaper.
+    'layout' is the precomputed compute_layout() result from _specialized.py.
+    """
     aligned_time = get_aligned_time()
     time_str = aligned_time.strftime("%Y/%m/%d/%H%M%S")
+    filename = wallpaper_filename(time_str)
+
+    # The same aligned time always yields the same wallpaper, so reuse it
+    existing = SAVE_DIR / filename
+    if existing.exists():
+        print(f"Wallpaper for {time_str} already exists")
+        set_wallpaper(str(existing))
+        return
 
     tiles = download_tiles(time_str)
     big_img = stitch_tiles(tiles)
     screen_size = PIC_SIZE  # or get_screen_size()
-    final_img = resize_and_center(big_img, screen_size, COVER_RATIO)
-    out_path = save_wallpaper(final_img)
-    set_wallpaper(out_path)
+    final_img = resize_and_center(big_img, screen_size, COVER_RATIO, layout=layout)
+    out_path = save_wallpaper(final_img, filename)
+
+    # Let osascript run while the cache is cleaned up
+    proc = set_wallpaper(out_path, wait=False)
+    try:
+        clean_old_images(SAVE_DIR, MAX_PIC, keep=out_path)
+    finally:
+        finish_set_wallpaper(proc, out_path)
+
+
+def generate_specialized(path=SPECIALIZED_PATH):
+    """
+    Write a launcher with this machine's ND, TILE_SIZE, screen size and
+    precomputed layout baked in as constants.
+    The launcher regenerates itself if config.json no longer matches them.
+    """
+    W, H = PIC_SIZE
+    big_size = ND * TILE_SIZE
+    target_size, offset_x, offset_y = compute_layout(big_size, PIC_SIZE, COVER_RATIO)
+    source = f'''#!/usr/bin/env python3
+"""Generated by himawari_wallpaper.generate_specialized(); do not edit."""
+
+import himawari_wallpaper
+
+ND = {ND}
+TILE_SIZE = {TILE_SIZE}
+SCREEN_SIZE = ({W}, {H})
+COVER_RATIO = {COVER_RATIO!r}
+TARGET_SIZE = {target_size}
+OFFSET_X = {offset_x}
+OFFSET_Y = {offset_y}
+
+
+def is_current():
+    """Return True if the baked constants still match config.json."""
+    hw = himawari_wallpaper
+    return (hw.ND, hw.TILE_SIZE, tuple(hw.PIC_SIZE), hw.COVER_RATIO) == (ND, TILE_SIZE, SCREEN_SIZE, COVER_RATIO)
+
+
+if __name__ == "__main__":
+    if is_current():
+        himawari_wallpaper.main(layout=(TARGET_SIZE, OFFSET_X, OFFSET_Y))
+    else:
+        print("⚠️ config.json changed since install; regenerating specialized launcher")
+        himawari_wallpaper.generate_specialized(__file__)
+        himawari_wallpaper.main()
+'''
+    Path(path).write_text(source)
+    print(f"Specialized launcher written: {path}")
+    return path
 
 
 if __name__ == "__main__":